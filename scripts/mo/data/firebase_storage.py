@@ -1,5 +1,5 @@
 import os.path
-from typing import List
+from typing import Iterator, List
 
 import firebase_admin
 from firebase_admin import credentials
@@ -38,6 +38,10 @@ class FirebaseStorage(Storage):
             records.append(map_dict_to_record(ref.id, ref.to_dict()))
         return records
 
+    def iter_all_records(self) -> Iterator:
+        for ref in self._records().stream():
+            yield map_dict_to_record(ref.id, ref.to_dict())
+
     def query_records(self, name_query=None, groups=None, model_types=None, show_downloaded=None,
                       show_not_downloaded=None) -> List:
 
@@ -66,13 +70,25 @@ class FirebaseStorage(Storage):
     def add_record(self, record: Record):
         self._records().add(map_record_to_dict(record))
 
+    def add_records(self, records: List):
+        for record in records:
+            self.add_record(record)
+
     def update_record(self, record: Record):
         ref = self._records().document(record.id_)
         ref.update(map_record_to_dict(record))
 
+    def update_records(self, records: List):
+        for record in records:
+            self.update_record(record)
+
     def remove_record(self, _id):
         self._records().document(_id).delete()
 
+    def remove_records(self, ids: List):
+        for id_ in ids:
+            self.remove_record(id_)
+
     def get_available_groups(self) -> List:
         records = self.get_all_records()
         groups = []
@@ -1,8 +1,11 @@
 import os
+import queue
 import shutil
 import sqlite3
 import threading
-from typing import List
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator, List
 
 from modules import shared
 
@@ -11,38 +14,173 @@ from scripts.mo.environment import env, logger
 from scripts.mo.models import Record, ModelType
 
 _DB_FILE = 'database.sqlite'
-_DB_VERSION = 7
+_DB_VERSION = 8
 _DB_TIMEOUT = 30
+_DB_CACHED_STATEMENTS = 256
+_DB_READERS = 4
+_SQL_MAX_IN_PARAMS = 500
+_DB_WRITER_PRAGMAS = '''PRAGMA journal_mode=WAL;
+                        PRAGMA synchronous=NORMAL;'''
+_DB_PRAGMAS = '''PRAGMA temp_store=MEMORY;
+                 PRAGMA mmap_size=268435456;
+                 PRAGMA cache_size=-20000;'''
+
+_SQL_CREATE_INDEXES = '''CREATE INDEX IF NOT EXISTS idx_record_name ON Record(_name);
+                         CREATE INDEX IF NOT EXISTS idx_record_url ON Record(url);
+                         CREATE INDEX IF NOT EXISTS idx_record_download_destination
+                             ON Record(download_path, download_filename);'''
+
+_MIGRATIONS = {
+    1: ['ALTER TABLE Record ADD COLUMN created_at INTEGER DEFAULT 0;'],
+    2: ["ALTER TABLE Record ADD COLUMN groups TEXT DEFAULT '';"],
+    3: ['ALTER TABLE Record RENAME COLUMN model_hash TO sha256_hash;',
+        "ALTER TABLE Record ADD COLUMN subdir TEXT DEFAULT '';"],
+    4: ["ALTER TABLE Record ADD COLUMN location TEXT DEFAULT '';"],
+    5: ['ALTER TABLE Record ADD COLUMN weight REAL DEFAULT 1;'],
+    6: ["ALTER TABLE Record ADD COLUMN backup_url TEXT DEFAULT '';"],
+    7: [_SQL_CREATE_INDEXES],
+}
+
+# Matches a whole entry of the comma-separated groups column, bound as '%,<escaped group>,%'.
+_SQL_GROUP_CONDITION = "',' || groups || ',' LIKE ? ESCAPE '\\'"
+
+_SQL_SELECT_ALL_RECORDS = 'SELECT * FROM Record'
+_SQL_SELECT_RECORD_BY_ID = 'SELECT * FROM Record WHERE id=?'
+_SQL_SELECT_RECORDS_BY_NAME = 'SELECT * FROM Record WHERE _name=?'
+_SQL_SELECT_RECORDS_BY_URL = 'SELECT * FROM Record WHERE url=?'
+_SQL_SELECT_RECORDS_BY_DOWNLOAD_DESTINATION = 'SELECT * FROM Record WHERE download_path=? AND download_filename=?'
+_SQL_SELECT_RECORDS_BY_GROUP = "SELECT * FROM Record WHERE " + _SQL_GROUP_CONDITION
+_SQL_SELECT_GROUPS = "SELECT DISTINCT groups FROM Record WHERE groups != ''"
+_SQL_SELECT_LOCATIONS = 'SELECT location FROM Record'
+_SQL_SELECT_IDS_AND_LOCATIONS = 'SELECT id, location FROM Record'
+_SQL_DELETE_RECORD = 'DELETE FROM Record WHERE id=?'
+_SQL_INSERT_RECORD = """INSERT INTO Record(
+        _name,
+        model_type,
+        download_url,
+        url,
+        download_path,
+        download_filename,
+        preview_url,
+        description,
+        positive_prompts,
+        negative_prompts,
+        sha256_hash,
+        md5_hash,
+        created_at,
+        groups,
+        subdir,
+        location,
+        weight,
+        backup_url) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"""
+_SQL_UPDATE_RECORD = """UPDATE Record SET
+        _name=?,
+        model_type=?,
+        download_url=?,
+        url=?,
+        download_path=?,
+        download_filename=?,
+        preview_url=?,
+        description=?,
+        positive_prompts=?,
+        negative_prompts=?,
+        sha256_hash=?,
+        md5_hash=?,
+        groups=?,
+        subdir=?,
+        location=?,
+        weight=?,
+        backup_url=?
+    WHERE id=?"""
+
+
+_MODEL_TYPE_BY_VALUE = {model_type.value: model_type for model_type in ModelType}
+
+
+def escape_like(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+# Lookups are bound as defaults so the per-row calls resolve them as locals rather than globals.
+def map_row_to_record(row, _model_types=_MODEL_TYPE_BY_VALUE, _record=Record) -> Record:
+    (id_, name, model_type, download_url, url, download_path, download_filename, preview_url, description,
+     positive_prompts, negative_prompts, sha256_hash, md5_hash, created_at, groups, subdir, location, weight,
+     backup_url) = row
+    return _record(
+        id_=id_,
+        name=name,
+        model_type=_model_types.get(model_type) or ModelType.by_value(model_type),
+        download_url=download_url,
+        url=url,
+        download_path=download_path,
+        download_filename=download_filename,
+        preview_url=preview_url,
+        description=description,
+        positive_prompts=positive_prompts,
+        negative_prompts=negative_prompts,
+        sha256_hash=sha256_hash,
+        md5_hash=md5_hash,
+        created_at=created_at,
+        groups=groups.split(',') if groups else [],
+        subdir=subdir,
+        location=location,
+        weight=weight,
+        backup_url=backup_url
+    )
+
+
+def map_record_to_insert_row(record: Record) -> tuple:
+    return (
+        record.name,
+        record.model_type.value,
+        record.download_url,
+        record.url,
+        record.download_path,
+        record.download_filename,
+        record.preview_url,
+        record.description,
+        record.positive_prompts,
+        record.negative_prompts,
+        record.sha256_hash,
+        record.md5_hash,
+        record.created_at,
+        ",".join(record.groups),
+        record.subdir,
+        record.location,
+        record.weight,
+        record.backup_url
+    )
 
 
-def map_row_to_record(row) -> Record:
-    return Record(
-        id_=row[0],
-        name=row[1],
-        model_type=ModelType.by_value(row[2]),
-        download_url=row[3],
-        url=row[4],
-        download_path=row[5],
-        download_filename=row[6],
-        preview_url=row[7],
-        description=row[8],
-        positive_prompts=row[9],
-        negative_prompts=row[10],
-        sha256_hash=row[11],
-        md5_hash=row[12],
-        created_at=row[13],
-        groups=row[14].split(',') if row[14] else [],
-        subdir=row[15],
-        location=row[16],
-        weight=row[17],
-        backup_url=row[18]
+def map_record_to_update_row(record: Record) -> tuple:
+    return (
+        record.name,
+        record.model_type.value,
+        record.download_url,
+        record.url,
+        record.download_path,
+        record.download_filename,
+        record.preview_url,
+        record.description,
+        record.positive_prompts,
+        record.negative_prompts,
+        record.sha256_hash,
+        record.md5_hash,
+        ",".join(record.groups),
+        record.subdir,
+        record.location,
+        record.weight,
+        record.backup_url,
+        record.id_
     )
 
 
 class SQLiteStorage(Storage):
 
     def __init__(self):
-        self.local = threading.local()
+        self._writer = None
+        self._writer_lock = threading.Lock()
+        self._readers = queue.Queue(maxsize=_DB_READERS)
         self._initialize()
 
     def _database_path(self):
@@ -52,9 +190,29 @@ class SQLiteStorage(Storage):
         return db_file_path
 
     def _connection(self):
-        if not hasattr(self.local, "connection"):
-            self.local.connection = sqlite3.connect(self._database_path(), _DB_TIMEOUT)
-        return self.local.connection
+        if self._writer is None:
+            self._writer = sqlite3.connect(self._database_path(), _DB_TIMEOUT,
+                                           cached_statements=_DB_CACHED_STATEMENTS, check_same_thread=False)
+            self._writer.executescript(_DB_WRITER_PRAGMAS)
+            self._writer.executescript(_DB_PRAGMAS)
+        return self._writer
+
+    @contextmanager
+    def _reader(self):
+        try:
+            connection = self._readers.get_nowait()
+        except queue.Empty:
+            uri = Path(self._database_path()).absolute().as_uri() + '?mode=ro'
+            connection = sqlite3.connect(uri, _DB_TIMEOUT, uri=True,
+                                         cached_statements=_DB_CACHED_STATEMENTS, check_same_thread=False)
+            connection.executescript(_DB_PRAGMAS)
+        try:
+            yield connection
+        finally:
+            try:
+                self._readers.put_nowait(connection)
+            except queue.Full:
+                connection.close()
 
     def _initialize(self):
         cursor = self._connection().cursor()
@@ -92,6 +250,7 @@ class SQLiteStorage(Storage):
         row = cursor.fetchone()
 
         if row is None:
+            cursor.executescript(_SQL_CREATE_INDEXES)
             cursor.execute(f'INSERT INTO Version VALUES ({_DB_VERSION})')
             self._connection().commit()
 
@@ -100,20 +259,24 @@ class SQLiteStorage(Storage):
             self._run_migration(version)
 
     def _run_migration(self, current_version):
-        migration_map = {
-            1: self._migrate_1_to_2,
-            2: self._migrate_2_to_3,
-            3: self._migrate_3_to_4,
-            4: self._migrate_4_to_5,
-            5: self._migrate_5_to_6,
-            6: self._migrate_6_to_7,
-        }
+        statements = []
         for ver in range(current_version, _DB_VERSION):
-            self._backup_database(ver)
-            migration = migration_map.get(ver)
+            migration = _MIGRATIONS.get(ver)
             if migration is None:
                 raise Exception(f'Missing SQLite migration from {ver} to {_DB_VERSION}')
-            migration()
+            statements.extend(migration)
+
+        self._backup_database(current_version)
+        connection = self._connection()
+        try:
+            connection.executescript('BEGIN;\n' + '\n'.join(statements) + f'''
+                DELETE FROM Version;
+                INSERT INTO Version VALUES ({_DB_VERSION});
+                COMMIT;''')
+        except sqlite3.Error:
+            connection.rollback()
+            raise
+        logger.info('Database migrated from v%s to v%s', current_version, _DB_VERSION)
 
     def _backup_database(self, migrate_from):
         db_file_path = self._database_path()
@@ -122,292 +285,127 @@ class SQLiteStorage(Storage):
         if last_backup_db_file_path and os.path.isfile(last_backup_db_file_path):
             os.remove(last_backup_db_file_path)
             logger.info('Backup database v%s removed', migrate_from - 1)
+        # Flush the write-ahead log so the copied file contains every committed change.
+        self._connection().execute('PRAGMA wal_checkpoint(TRUNCATE)')
         shutil.copy(db_file_path, backup_db_file_path)
         logger.info('Database v%s backup created', migrate_from)
 
-    def _migrate_1_to_2(self):
-        cursor = self._connection().cursor()
-        cursor.execute('ALTER TABLE Record ADD COLUMN created_at INTEGER DEFAULT 0;')
-        cursor.execute("DELETE FROM Version")
-        cursor.execute('INSERT INTO Version VALUES (2)')
-        self._connection().commit()
-
-    def _migrate_2_to_3(self):
-        cursor = self._connection().cursor()
-        cursor.execute("ALTER TABLE Record ADD COLUMN groups TEXT DEFAULT '';")
-        cursor.execute("DELETE FROM Version")
-        cursor.execute('INSERT INTO Version VALUES (3)')
-        self._connection().commit()
-
-    def _migrate_3_to_4(self):
-        cursor = self._connection().cursor()
-        cursor.execute("ALTER TABLE Record RENAME COLUMN model_hash TO sha256_hash;")
-        cursor.execute("ALTER TABLE Record ADD COLUMN subdir TEXT DEFAULT '';")
-        cursor.execute("DELETE FROM Version")
-        cursor.execute('INSERT INTO Version VALUES (4)')
-        self._connection().commit()
-
-    def _migrate_4_to_5(self):
-        cursor = self._connection().cursor()
-        cursor.execute("ALTER TABLE Record ADD COLUMN location TEXT DEFAULT '';")
-        cursor.execute("DELETE FROM Version")
-        cursor.execute('INSERT INTO Version VALUES (5)')
-        self._connection().commit()
-
-    def _migrate_5_to_6(self):
-        cursor = self._connection().cursor()
-        cursor.execute("ALTER TABLE Record ADD COLUMN weight REAL DEFAULT 1;")
-        cursor.execute("DELETE FROM Version")
-        cursor.execute('INSERT INTO Version VALUES (6)')
-        self._connection().commit()
-
-    def _migrate_6_to_7(self):
-        cursor = self._connection().cursor()
-        cursor.execute("ALTER TABLE Record ADD COLUMN backup_url TEXT DEFAULT '';")
-        cursor.execute("DELETE FROM Version")
-        cursor.execute('INSERT INTO Version VALUES (7)')
-        self._connection().commit()
-
     def get_all_records(self) -> List:
-        cursor = self._connection().cursor()
-        cursor.execute('SELECT * FROM Record')
-        rows = cursor.fetchall()
-        result = []
-        for row in rows:
-            result.append(map_row_to_record(row))
-        return result
+        with self._reader() as connection:
+            cursor = connection.execute(_SQL_SELECT_ALL_RECORDS)
+            return [map_row_to_record(row) for row in cursor]
+
+    def iter_all_records(self) -> Iterator:
+        with self._reader() as connection:
+            for row in connection.execute(_SQL_SELECT_ALL_RECORDS):
+                yield map_row_to_record(row)
 
     def query_records(self, name_query: str = None, groups=None, model_types=None, show_downloaded=True,
                       show_not_downloaded=True) -> List:
+        if not show_downloaded and not show_not_downloaded:
+            return []
 
-        query = 'SELECT * FROM Record'
-
-        is_where_appended = False
-        append_and = False
+        conditions = []
+        params = []
 
         if name_query is not None and name_query:
-            if not is_where_appended:
-                query += ' WHERE'
-                is_where_appended = True
-
-            query += f" LOWER(_name) LIKE '%{name_query}%'"
-            append_and = True
+            # LIKE already ignores ASCII case and compares other characters exactly, so the term is bound as is.
+            conditions.append("_name LIKE ? ESCAPE '\\'")
+            params.append(f'%{escape_like(name_query)}%')
 
         if model_types is not None and len(model_types) > 0:
-            if not is_where_appended:
-                query += ' WHERE'
-                is_where_appended = True
-
-            if append_and:
-                query += ' AND'
-
-            query += ' ('
-            append_or = False
-            for model_type in model_types:
-                if append_or:
-                    query += ' OR'
-                query += f" model_type='{model_type}'"
-                append_or = True
-
-            query += ')'
-
-            append_and = True
-            pass
+            conditions.append('model_type IN (' + ', '.join('?' * len(model_types)) + ')')
+            params.extend(model_types)
 
         if groups is not None and len(groups) > 0:
-            if not is_where_appended:
-                query += ' WHERE'
-
             for group in groups:
-                if append_and:
-                    query += ' AND'
-                query += f" LOWER(groups) LIKE '%{group}%'"
-                append_and = True
-
-        logger.debug('query: %s',query)
-        cursor = self._connection().cursor()
-        cursor.execute(query)
-        rows = cursor.fetchall()
-        result = []
-        for row in rows:
-            record = map_row_to_record(row)
-            is_downloaded = bool(record.location) and os.path.exists(record.location)
-
-            if show_downloaded and is_downloaded:
-                result.append(record)
-            elif show_not_downloaded and not is_downloaded:
-                result.append(record)
+                conditions.append(_SQL_GROUP_CONDITION)
+                params.append(f'%,{escape_like(group)},%')
+
+        where = ' WHERE ' + ' AND '.join(conditions) if conditions else ''
+
+        logger.debug('query where: %s, params: %s', where, params)
+        with self._reader() as connection:
+            if show_downloaded and show_not_downloaded:
+                cursor = connection.execute(_SQL_SELECT_ALL_RECORDS + where, params)
+                return [map_row_to_record(row) for row in cursor]
+
+            # Only one of the flags is set here, so select ids and locations first, check each location on disk
+            # once and load full rows only for the records that pass.
+            ids = []
+            is_downloaded_by_location = {}
+            for id_, location in connection.execute(_SQL_SELECT_IDS_AND_LOCATIONS + where, params):
+                if location not in is_downloaded_by_location:
+                    is_downloaded_by_location[location] = bool(location) and os.path.exists(location)
+
+                if is_downloaded_by_location[location] == show_downloaded:
+                    ids.append(id_)
+
+            result = []
+            for i in range(0, len(ids), _SQL_MAX_IN_PARAMS):
+                chunk = ids[i:i + _SQL_MAX_IN_PARAMS]
+                query = _SQL_SELECT_ALL_RECORDS + ' WHERE id IN (' + ', '.join('?' * len(chunk)) + ')'
+                result.extend(map_row_to_record(row) for row in connection.execute(query, chunk))
 
         return result
 
     def get_record_by_id(self, id_) -> Record:
-        cursor = self._connection().cursor()
-        cursor.execute('SELECT * FROM Record WHERE id=?', (id_,))
-        row = cursor.fetchone()
+        with self._reader() as connection:
+            row = connection.execute(_SQL_SELECT_RECORD_BY_ID, (id_,)).fetchone()
         return None if row is None else map_row_to_record(row)
 
     def get_records_by_group(self, group: str) -> List:
-        cursor = self._connection().cursor()
-        cursor.execute(f"SELECT * FROM Record WHERE LOWER(groups) LIKE '%{group}%'")
-        rows = cursor.fetchall()
-        result = []
-        for row in rows:
-            result.append(map_row_to_record(row))
-        return result
+        with self._reader() as connection:
+            cursor = connection.execute(_SQL_SELECT_RECORDS_BY_GROUP, (f'%,{escape_like(group)},%',))
+            return [map_row_to_record(row) for row in cursor]
 
     def get_records_by_query(self, query: str) -> List:
-        cursor = self._connection().cursor()
-        cursor.execute(query)
-        rows = cursor.fetchall()
-        result = []
-        for row in rows:
-            result.append(map_row_to_record(row))
-        return result
+        with self._reader() as connection:
+            cursor = connection.execute(query)
+            return [map_row_to_record(row) for row in cursor]
 
     def add_record(self, record: Record):
-        cursor = self._connection().cursor()
-        data = (
-            record.name,
-            record.model_type.value,
-            record.download_url,
-            record.url,
-            record.download_path,
-            record.download_filename,
-            record.preview_url,
-            record.description,
-            record.positive_prompts,
-            record.negative_prompts,
-            record.sha256_hash,
-            record.md5_hash,
-            record.created_at,
-            ",".join(record.groups),
-            record.subdir,
-            record.location,
-            record.weight,
-            record.backup_url
-        )
-        cursor.execute(
-            """INSERT INTO Record(
-                    _name,
-                    model_type,
-                    download_url,
-                    url,
-                    download_path,
-                    download_filename,
-                    preview_url,
-                    description,
-                    positive_prompts,
-                    negative_prompts,
-                    sha256_hash,
-                    md5_hash,
-                    created_at,
-                    groups,
-                    subdir,
-                    location,
-                    weight,
-                    backup_url) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
-            data)
-        self._connection().commit()
+        self.add_records([record])
+
+    def add_records(self, records: List):
+        with self._writer_lock, self._connection() as connection:
+            connection.executemany(_SQL_INSERT_RECORD, [map_record_to_insert_row(record) for record in records])
 
     def update_record(self, record: Record):
-        cursor = self._connection().cursor()
-        data = (
-            record.name,
-            record.model_type.value,
-            record.download_url,
-            record.url,
-            record.download_path,
-            record.download_filename,
-            record.preview_url,
-            record.description,
-            record.positive_prompts,
-            record.negative_prompts,
-            record.sha256_hash,
-            record.md5_hash,
-            ",".join(record.groups),
-            record.subdir,
-            record.location,
-            record.weight,
-            record.backup_url,
-            record.id_
-        )
-        cursor.execute(
-            """UPDATE Record SET 
-                    _name=?,
-                    model_type=?,
-                    download_url=?,
-                    url=?,
-                    download_path=?,
-                    download_filename=?,
-                    preview_url=?,
-                    description=?,
-                    positive_prompts=?,
-                    negative_prompts=?,
-                    sha256_hash=?,
-                    md5_hash=?,
-                    groups=?,
-                    subdir=?,
-                    location=?,
-                    weight=?,
-                    backup_url=?
-                WHERE id=?
-            """, data
-        )
+        self.update_records([record])
 
-        self._connection().commit()
+    def update_records(self, records: List):
+        with self._writer_lock, self._connection() as connection:
+            connection.executemany(_SQL_UPDATE_RECORD, [map_record_to_update_row(record) for record in records])
 
     def remove_record(self, _id):
-        cursor = self._connection().cursor()
-        cursor.execute("DELETE FROM Record WHERE id=?", (_id,))
-        self._connection().commit()
+        self.remove_records([_id])
 
-    def get_available_groups(self) -> List:
-        cursor = self._connection().cursor()
-        cursor.execute('SELECT groups FROM Record')
-        rows = cursor.fetchall()
-        result = []
-        for row in rows:
-            if row[0]:
-                result.extend(row[0].split(","))
+    def remove_records(self, ids: List):
+        with self._writer_lock, self._connection() as connection:
+            connection.executemany(_SQL_DELETE_RECORD, [(id_,) for id_ in ids])
 
-        result = list(set(result))
-        return list(filter(None, result))
+    def get_available_groups(self) -> List:
+        with self._reader() as connection:
+            cursor = connection.execute(_SQL_SELECT_GROUPS)
+            return list({group for row in cursor for group in row[0].split(',') if group})
 
     def get_all_records_locations(self) -> List:
-        cursor = self._connection().cursor()
-        cursor.execute('SELECT location FROM Record')
-        rows = cursor.fetchall()
-        result = []
-        for row in rows:
-            if row[0]:
-                result.append(row[0])
-
-        return result
+        with self._reader() as connection:
+            cursor = connection.execute(_SQL_SELECT_LOCATIONS)
+            return [row[0] for row in cursor if row[0]]
 
     def get_records_by_name(self, record_name) -> List:
-        cursor = self._connection().cursor()
-        cursor.execute('SELECT * FROM Record WHERE _name=?', (record_name,))
-        rows = cursor.fetchall()
-        result = []
-        for row in rows:
-            result.append(map_row_to_record(row))
-        return result
+        with self._reader() as connection:
+            cursor = connection.execute(_SQL_SELECT_RECORDS_BY_NAME, (record_name,))
+            return [map_row_to_record(row) for row in cursor]
 
     def get_records_by_url(self, url) -> List:
-        cursor = self._connection().cursor()
-        cursor.execute('SELECT * FROM Record WHERE url=?', (url,))
-        rows = cursor.fetchall()
-        result = []
-        for row in rows:
-            result.append(map_row_to_record(row))
-        return result
+        with self._reader() as connection:
+            cursor = connection.execute(_SQL_SELECT_RECORDS_BY_URL, (url,))
+            return [map_row_to_record(row) for row in cursor]
 
     def get_records_by_download_destination(self, download_path, download_filename) -> List:
-        cursor = self._connection().cursor()
-        cursor.execute('SELECT * FROM Record WHERE download_path=? AND download_filename=?',
-                       (download_path, download_filename,))
-        rows = cursor.fetchall()
-        result = []
-        for row in rows:
-            result.append(map_row_to_record(row))
-        return result
+        with self._reader() as connection:
+            cursor = connection.execute(_SQL_SELECT_RECORDS_BY_DOWNLOAD_DESTINATION, (download_path, download_filename,))
+            return [map_row_to_record(row) for row in cursor]
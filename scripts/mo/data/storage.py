@@ -1,5 +1,5 @@
 from abc import ABC, abstractmethod
-from typing import Dict, List
+from typing import Dict, Iterator, List
 
 from scripts.mo.models import Record, ModelType
 
@@ -58,6 +58,10 @@ class Storage(ABC):
     def get_all_records(self) -> List:
         pass
 
+    @abstractmethod
+    def iter_all_records(self) -> Iterator:
+        pass
+
     @abstractmethod
     def query_records(self, name_query=None, groups=None, model_types=None, show_downloaded=None,
                       show_not_downloaded=None) -> List:
@@ -71,14 +75,26 @@ class Storage(ABC):
     def add_record(self, record: Record):
         pass
 
+    @abstractmethod
+    def add_records(self, records: List):
+        pass
+
     @abstractmethod
     def update_record(self, record: Record):
         pass
 
+    @abstractmethod
+    def update_records(self, records: List):
+        pass
+
     @abstractmethod
     def remove_record(self, _id):
         pass
 
+    @abstractmethod
+    def remove_records(self, ids: List):
+        pass
+
     @abstractmethod
     def get_available_groups(self) -> List:
         pass
@@ -260,41 +260,36 @@ def _ui_hash_cache():
 
 
 def _on_remove_duplicates_click():
-    records = env.storage.get_all_records()
     counter_set = set()
     duplicates_list = []
 
-    for record in records:
+    for record in env.storage.iter_all_records():
         key = f'{record.name}-{record.url}'
         if key in counter_set:
             duplicates_list.append(record)
         else:
             counter_set.add(key)
 
-    for record in duplicates_list:
-        env.storage.remove_record(record.id_)
+    env.storage.remove_records([record.id_ for record in duplicates_list])
 
     return f'{len(duplicates_list)} duplicates has been removed.'
 
 
 def _on_remove_all_records_click():
-    records = env.storage.get_all_records()
-    for record in records:
-        env.storage.remove_record(record.id_)
+    env.storage.remove_records([record.id_ for record in env.storage.iter_all_records()])
 
     return "All records has been removed."
 
 
 def _on_add_tag_to_all_records_click(tag):
-    records = env.storage.get_all_records()
-    records_updated_count = 0
-    for record in records:
+    records_to_update = []
+    for record in env.storage.iter_all_records():
         if tag not in record.groups:
             record.groups.append(tag)
-            env.storage.update_record(record)
-            records_updated_count += 1
+            records_to_update.append(record)
 
-    return f'{records_updated_count} records has been updated.'
+    env.storage.update_records(records_to_update)
+    return f'{len(records_to_update)} records has been updated.'
 
 
 def _ui_debug_utils():
@@ -20,16 +20,13 @@ def _on_import_file_change(import_file):
     if len(records_dict_list) == 0:
         return gr.HTML.update('Nothing to import')
     else:
-        records_imported = []
-        for record_dict in records_dict_list:
-            record = map_dict_to_record('', record_dict)
-            env.storage.add_record(record)
-            records_imported.append(record.name)
+        records_imported = [map_dict_to_record('', record_dict) for record_dict in records_dict_list]
+        env.storage.add_records(records_imported)
 
         output = f'<b>Imported records: ({len(records_imported)})</b>'
-        for name in records_imported:
+        for record in records_imported:
             output += '<br>'
-            output += name
+            output += record.name
         return gr.HTML.update(value=output)
 
 